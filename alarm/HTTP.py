@@ -5,11 +5,15 @@ try:
     import usocket as socket
 except:
     import socket
-import json
+try:
+    import ujson as json
+except:
+    import json
+import micropython
 from machine import Pin
 
-from .logging import debug, info, warn, error, fatal
-from .utils import alarm, getSubstringFromList
+from .logging import debug, info, warn, error, fatal, flush
+from .utils import alarm
 
 CODES = {
   100: "Continue",
@@ -54,9 +58,268 @@ CODES = {
   505: "HTTP Version Not Supported"
 }
 
+# Seconds to wait for the next request on a kept alive connection
+KEEP_ALIVE_TIMEOUT = 5
+
+# Responses are built once at import so nothing is formatted per request.
+# Successful responses may leave the connection open for further requests.
+# Responses never have a body so give their length where it is allowed
+RESPONSES = {}
+KEEP_ALIVE_RESPONSES = {}
+for code, msg in CODES.items():
+    status = "HTTP/1.1 {} {} \r\n".format(code, msg)
+    if code >= 200 and code not in (204, 304):
+        status += "Content-Length: 0\r\n"
+
+    RESPONSES[code] = (status + "Connection: close\r\n\r\n").encode("ascii")
+    if 200 <= code < 300:
+        KEEP_ALIVE_RESPONSES[code] = (status + "Connection: keep-alive\r\nKeep-Alive: timeout={}\r\n\r\n".format(KEEP_ALIVE_TIMEOUT)).encode("ascii")
+del code, msg, status
+
+# Size of the buffer requests are read into. Offsets into this buffer
+# must fit into the fields packed by parseHeaders
+BUF_SIZE = 2048
+
+# Maximum number of requests to serve on a single connection
+MAX_REQUESTS = 100
+
+# Byte strings used while parsing requests. Header names are lower case
+# and include the colon as expected by findHeader. The viper scanners
+# use the lengths below so they never read past the end of a pattern
+_POST = b"POST "
+_CTYPE = b"content-type:"
+_CLENGTH = b"content-length:"
+_CONNECTION = b"connection:"
+_APP_JSON = b"application/json"
+_CLOSE = b"close"
+_KEEP_ALIVE = b"keep-alive"
+_STATE = b'"state"'
+_ALERTING = b'"alerting"'
+
+_POST_LEN = len(_POST)
+_CTYPE_LEN = len(_CTYPE)
+_CLENGTH_LEN = len(_CLENGTH)
+_CONNECTION_LEN = len(_CONNECTION)
+_STATE_LEN = len(_STATE)
+_ALERTING_LEN = len(_ALERTING)
+
+
+@micropython.viper
+def parseHeaders(buf: ptr8, n: int) -> int:
+    """
+    parseHeaders Scan a raw HTTP request
+
+    Scan the first n bytes of buf for the end of the headers, the
+    request method and the Content-Type header without creating any
+    Python objects.
+
+    :param buf: Buffer containing the raw request
+    :type buf: bytearray
+    :param n: Number of valid bytes in buf
+    :type n: int
+    :return: Packed result. Bits 0-11 hold the offset of the body (0 if
+        the end of the headers has not been received yet), bits 12-22
+        the offset of the Content-Type value (0 if not present), bits
+        23-28 its length and bit 29 is set if the method is POST. This
+        keeps the result within a MicroPython small int
+    :rtype: int
+    """
+
+    method = ptr8(_POST)
+    method_len = int(_POST_LEN)
+    name = ptr8(_CTYPE)
+    name_len = int(_CTYPE_LEN)
+
+    post = 0
+    if n >= method_len:
+        k = 0
+        while k < method_len and buf[k] == method[k]:
+            k += 1
+        if k == method_len:
+            post = 1
+
+    ct_off = 0
+    ct_len = 0
+    i = 0
+    while i < n - 1:
+        if buf[i] != 0x0D or buf[i + 1] != 0x0A:
+            i += 1
+            continue
+
+        # Blank line denotes end of headers
+        if i + 3 < n and buf[i + 2] == 0x0D and buf[i + 3] == 0x0A:
+            return (post << 29) | (ct_len << 23) | (ct_off << 12) | (i + 4)
+
+        i += 2
+        if ct_off == 0 and i + name_len <= n:
+            # Case insensitive match of the header name
+            k = 0
+            while k < name_len and (buf[i + k] | 0x20) == name[k]:
+                k += 1
+            if k == name_len:
+                j = i + name_len
+                while j < n and buf[j] == 0x20:
+                    j += 1
+                ct_off = j
+                while j < n and buf[j] != 0x0D:
+                    j += 1
+                ct_len = j - ct_off
+                if ct_len > 0x3F:
+                    ct_len = 0x3F
+
+    return 0
+
+
+@micropython.viper
+def findEndOfHeaders(buf: ptr8, start: int, n: int) -> int:
+    """
+    findEndOfHeaders Find the blank line ending the headers
+
+    Search buf[start:n] for the end of the headers. The terminator may
+    begin up to three bytes before start so that it is still found when
+    it is split across two reads.
+
+    :param buf: Buffer containing the raw request
+    :type buf: bytearray
+    :param start: Offset to resume the search from
+    :type start: int
+    :param n: Number of valid bytes in buf
+    :type n: int
+    :return: Offset of the body. 0 if the end of the headers has not
+        been received yet
+    :rtype: int
+    """
+
+    i = start - 3
+    if i < 0:
+        i = 0
+
+    while i + 3 < n:
+        if buf[i] == 0x0D and buf[i + 1] == 0x0A and buf[i + 2] == 0x0D and buf[i + 3] == 0x0A:
+            return i + 4
+        i += 1
+
+    return 0
+
+
+@micropython.viper
+def findHeader(buf: ptr8, n: int, name: ptr8, name_len: int) -> int:
+    """
+    findHeader Find the value of a header
+
+    Search the first n bytes of buf for a header line starting with
+    name. The match is case insensitive so name must be lower case and
+    include the trailing colon.
+
+    :param buf: Buffer containing the raw request
+    :type buf: bytearray
+    :param n: Number of bytes of buf containing headers
+    :type n: int
+    :param name: Lower case header name including the colon
+    :type name: bytes
+    :param name_len: Length of name
+    :type name_len: int
+    :return: Packed result. Bits 0-10 hold the length of the value and
+        bits 11-21 its offset. 0 if the header was not found
+    :rtype: int
+    """
+
+    i = 0
+    while i < n - 1:
+        if buf[i] != 0x0D or buf[i + 1] != 0x0A:
+            i += 1
+            continue
+
+        i += 2
+        if i + name_len > n:
+            break
+
+        k = 0
+        while k < name_len and (buf[i + k] | 0x20) == name[k]:
+            k += 1
+        if k == name_len:
+            j = i + name_len
+            while j < n and buf[j] == 0x20:
+                j += 1
+            off = j
+            while j < n and buf[j] != 0x0D:
+                j += 1
+            return (off << 11) | (j - off)
+
+    return 0
+
+
+@micropython.viper
+def isHTTP11(buf: ptr8, n: int) -> bool:
+    """
+    isHTTP11 Check if the request line is HTTP/1.1
+
+    :param buf: Buffer containing the raw request
+    :type buf: bytearray
+    :param n: Number of valid bytes in buf
+    :type n: int
+    :return: Does the request line end in HTTP/1.1?
+    :rtype: bool
+    """
+
+    i = 0
+    while i < n and buf[i] != 0x0D:
+        i += 1
+
+    return i >= 8 and buf[i - 3] == 0x31 and buf[i - 2] == 0x2E and buf[i - 1] == 0x31
+
+
+@micropython.viper
+def isAlerting(buf: ptr8, start: int, end: int) -> bool:
+    """
+    isAlerting Check if a JSON body has a state of alerting
+
+    Scan the JSON body in buf[start:end] for a "state" key whose value
+    is "alerting" without parsing the document.
+
+    :param buf: Buffer containing the raw request
+    :type buf: bytearray
+    :param start: Offset of the body
+    :type start: int
+    :param end: Offset of the end of the body
+    :type end: int
+    :return: Is the state alerting?
+    :rtype: bool
+    """
+
+    key = ptr8(_STATE)
+    key_len = int(_STATE_LEN)
+    value = ptr8(_ALERTING)
+    value_len = int(_ALERTING_LEN)
+
+    i = start
+    while i + key_len <= end:
+        k = 0
+        while k < key_len and buf[i + k] == key[k]:
+            k += 1
+        if k < key_len:
+            i += 1
+            continue
+
+        # Skip to the value
+        j = i + key_len
+        while j < end and (buf[j] == 0x20 or buf[j] == 0x3A or buf[j] == 0x09 or buf[j] == 0x0D or buf[j] == 0x0A):
+            j += 1
+
+        if j + value_len <= end:
+            k = 0
+            while k < value_len and buf[j + k] == value[k]:
+                k += 1
+            if k == value_len:
+                return True
+
+        i = j
+
+    return False
+
 
 class HTTP:
-    def __init__(self, port: int, max_con: int, addr_family: str = "INET")  -> None:
+    def __init__(self, port: int, max_con: int, addr_family: str = "INET", validate: bool = False)  -> None:
         """
         __init__ Initialize the web server
 
@@ -70,12 +333,17 @@ class HTTP:
         :param addr_family: Address family to use. One of INET or INET6,
             defaults to INET
         :type addr_family: str, optional
+        :param validate: Should the JSON body be fully parsed and
+            validated? Otherwise it is only scanned for the state,
+            defaults to False
+        :type validate: bool, optional
         :return: Socket to listen on
         :rtype: socket
         """
 
         info("Network", "Initializing HTTP server")
 
+        self._validate = validate
         self._buzzer = Pin(2, Pin.OUT)
         alarm(self._buzzer, 2000, 250, 500)
 
@@ -88,6 +356,15 @@ class HTTP:
         self._s.bind(('', port))
         self._s.listen(max_con)
 
+        # Requests are read into a single preallocated buffer to avoid
+        # allocating on the heap for every request
+        self._buf = bytearray(BUF_SIZE)
+        self._mv = memoryview(self._buf)
+
+        # The first call into ujson is much slower than later ones so
+        # warm it up now rather than on the first notification
+        json.dumps(None)
+
         info("Network", "HTTP server initialized")        
 
     def listen(self) -> None:
@@ -96,65 +373,171 @@ class HTTP:
         """
 
         info("Network", "Waiting for requests")
-        
 
         while True:
+            # Don't hold entries back while blocked waiting for a client
+            flush()
             self._conn, addr = self._s.accept()
-            info("Network", "Got connection from {}".format(addr))
+            info("Network", "Got connection from %s", addr)
 
-            # Variables to store request components
-            request = ""
-        
+            # Don't let an idle connection block other clients forever
+            self._conn.settimeout(KEEP_ALIVE_TIMEOUT)
 
-            # Read request
-            while True:
-                chunk = self._conn.recv(1024)
-                request += chunk.decode("utf-8")
+            for i in range(MAX_REQUESTS):
+                try:
+                    code, keep_alive = self._handle_request(self._conn)
+                    if not code:
+                        # Client closed the connection between requests
+                        self._close()
+                        break
 
-                # Denotes end of request
-                if not chunk or chunk == b"\r\n" or b"\r\n" in chunk:
+                    keep_alive = keep_alive and code in KEEP_ALIVE_RESPONSES and i < MAX_REQUESTS - 1
+                    self._send(code, keep_alive)
+
+                    # Don't hold entries back while waiting for the next
+                    # request on a kept alive connection
+                    flush()
+                except OSError:
+                    # Connection was reset or timed out waiting for a request
+                    self._close()
                     break
 
-            # Parse request
-            headers, content = request.split("\r\n\r\n")
-            headers = headers.split("\r\n")
-            # Check it was a post request
-            if headers[0][0:4] != "POST":
-                info("Network", "Request was not a POST request")
-                self._send(405)
-                continue
-
-            # Make sure it is json we are using                
-            index = getSubstringFromList(headers, "Content-Type: ")
-            if index != -1:
-                try:
-                    content_type = headers[index][14:]
-                except IndexError:
-                    info("Network", "Could not find Content-Type header")
-                    self._send(400)
-            else:
-                info("Network", "Could not find Content-Type header")
-                self._send(400)
-
-            if content_type != "application/json":
-                info("Network", "Expected content type application/json. Got {}".format(content_type))
-                self._send(400)
-                continue
-
-            # Now we process the data and set alarms
+                if not keep_alive:
+                    break
+
+    def _handle_request(self, conn: socket.socket) -> tuple:
+        """
+        _handle_request Read and process a single request
+
+        Read a request from the connection, validate it and sound the
+        alarm if required.
+
+        :param conn: Connection to read the request from
+        :type conn: socket
+        :return: Response code to send to the client and whether the
+            client allows the connection to be kept alive. The code is 0
+            if the client closed the connection before sending a request
+        :rtype: tuple
+        """
+
+        buf = self._buf
+        mv = self._mv
+        off = 0
+        parsed = 0
+
+        # Read request until we have all of the headers. Only the newly
+        # read bytes are searched for the end of the headers, the full
+        # parse is done once they are all in the buffer
+        while off < BUF_SIZE:
+            n = conn.readinto(mv[off:])
+            if not n:
+                if not off:
+                    return 0, False
+                break
+
+            eoh = findEndOfHeaders(buf, off, off + n)
+            off += n
+            if eoh:
+                parsed = parseHeaders(buf, eoh)
+                break
+
+        body_off = parsed & 0xFFF
+        if not body_off:
+            if off == BUF_SIZE:
+                info("Network", "Request headers too large")
+                return 413, False
+            info("Network", "Request headers incomplete")
+            return 400, False
+
+        # HTTP/1.1 connections are persistent unless the client asks to
+        # close them. HTTP/1.0 connections must explicitly ask to persist
+        keep_alive = isHTTP11(buf, body_off)
+        connection = findHeader(buf, body_off, _CONNECTION, _CONNECTION_LEN)
+        if connection:
+            value = bytes(mv[connection >> 11:(connection >> 11) + (connection & 0x7FF)]).lower()
+            if _CLOSE in value:
+                keep_alive = False
+            elif _KEEP_ALIVE in value:
+                keep_alive = True
+
+        # Check it was a post request
+        if not parsed >> 29:
+            info("Network", "Request was not a POST request")
+            return 405, keep_alive
+
+        # Make sure it is json we are using
+        ct_off = (parsed >> 12) & 0x7FF
+        if not ct_off:
+            info("Network", "Could not find Content-Type header")
+            return 400, keep_alive
+
+        content_type = bytes(mv[ct_off:ct_off + ((parsed >> 23) & 0x3F)])
+        if content_type != _APP_JSON:
+            info("Network", "Expected content type application/json. Got %s", content_type)
+            return 400, keep_alive
+
+        # Read exactly the body the client says it is sending so we don't
+        # block waiting for data that will never arrive
+        length = findHeader(buf, body_off, _CLENGTH, _CLENGTH_LEN)
+        if not length:
+            info("Network", "Could not find Content-Length header")
+            return 411, keep_alive
+
+        try:
+            length = int(bytes(mv[length >> 11:(length >> 11) + (length & 0x7FF)]))
+        except ValueError:
+            info("Network", "Invalid Content-Length header")
+            return 400, keep_alive
+
+        if length < 0:
+            info("Network", "Invalid Content-Length header")
+            return 400, keep_alive
+
+        end = body_off + length
+        if end > BUF_SIZE:
+            info("Network", "Request body too large")
+            return 413, keep_alive
+
+        while off < end:
+            n = conn.readinto(mv[off:end])
+            if not n:
+                info("Network", "Request body incomplete")
+                return 400, keep_alive
+            off += n
+
+        # Pipelined requests aren't supported so don't keep the
+        # connection open if the client has already sent more
+        if off > end:
+            keep_alive = False
+
+        # Now we process the data and set alarms
+        if self._validate:
+            # ujson reads straight from the buffer so the body is never
+            # copied or decoded
             try:
-                data = json.loads(content)
-            except:
+                data = json.loads(mv[body_off:end])
+            except ValueError:
                 error("Network", "Failed to load JSON")
-                self._send(500)
-            
-            if data["state"] == "alerting":
-                info("Network", "Recieved alerting notification")
-                alarm(self._buzzer, 5000, 500, 100)
-            
-            self._send(204)
-            
-    def _send(self, code: int) -> None:
+                return 500, keep_alive
+
+            if not isinstance(data, dict):
+                info("Network", "Expected a JSON object")
+                return 400, keep_alive
+
+            alerting = data.get("state") == "alerting"
+        else:
+            alerting = isAlerting(buf, body_off, end)
+
+        if alerting:
+            info("Network", "Recieved alerting notification")
+            # Write the notification out before blocking on the buzzer
+            flush()
+            alarm(self._buzzer, 5000, 500, 100)
+
+        return 204, keep_alive
+
+    @micropython.native
+    def _send(self, code: int, keep_alive: bool = False) -> None:
         """
         _send Send a response code
 
@@ -162,13 +545,28 @@ class HTTP:
 
         :param code: Code to send
         :type code: int
+        :param keep_alive: Should the connection be left open for further
+            requests? Only honoured for successful responses, defaults to
+            False
+        :type keep_alive: bool, optional
         """
 
-        if code not in CODES:
+        if code not in RESPONSES:
             raise ValueError("Invalid response code")
 
-        self._conn.send("HTTP/1.1 {} {} \r\n\r\n".format(code, CODES[code]))
+        if keep_alive and code in KEEP_ALIVE_RESPONSES:
+            self._conn.sendall(KEEP_ALIVE_RESPONSES[code])
+            return
+
+        self._conn.sendall(RESPONSES[code])
 
         # Ensure connection gets closed at end
+        self._close()
+
+    def _close(self) -> None:
+        """
+        _close Close the current connection
+        """
+
         self._conn.close()
         debug("Network", "Closed connection")
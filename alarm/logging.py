@@ -8,87 +8,183 @@ tools. Based upon
 https://github.com/louislam/uptime-kuma/blob/39aa0a7f07644ecdd99e0a8ddacbbb24e2afd931/src/util.ts#L61-L148
 """
 
+import micropython
 import time
 import sys
 
 
-def log(module: str, msg: str, level: str) -> None:
+# Numeric value of each log level. Entries below LEVEL are discarded
+DEV = 0
+DEBUG = 1
+INFO = 2
+WARN = 3
+ERROR = 4
+FATAL = 5
+
+LEVELS = {
+    "dev": DEV,
+    "debug": DEBUG,
+    "info": INFO,
+    "warn": WARN,
+    "error": ERROR,
+    "fatal": FATAL
+}
+
+# Minimum level to write. Defaults to info
+LEVEL = INFO
+
+# Entries are collected in a buffer and written out together. The buffer
+# is flushed once it is FLUSH_THRESHOLD bytes full, when an entry is
+# logged FLUSH_INTERVAL ms or more after the last flush or immediately
+# for warn, error and fatal entries. The interval is only checked when
+# logging so callers flush() before blocking for long periods
+BUF_SIZE = 512
+FLUSH_THRESHOLD = BUF_SIZE * 3 // 4
+FLUSH_INTERVAL = 1000
+
+_buf = bytearray(BUF_SIZE)
+_mv = memoryview(_buf)
+_off = 0
+_last_flush = 0
+
+
+@micropython.native
+def log(module: str, msg: str, level: str, args: tuple = ()) -> None:
     """
     log Create a log entry to stdout
     Create a standardised log entry to stdout with information on
     where it came from as well as the log level
     :param module: Section of application log originates from
     :type module: str
-    :param msg: Log message
+    :param msg: Log message. Formatted with args using % if args are
+        given
     :type msg: str
     :param level: Log level
     :type level: str
+    :param args: Arguments to format msg with, defaults to ()
+    :type args: tuple, optional
     """
 
-    level = level.upper()
-    current_time = time.time_ns()
-    formatted_message = "{} [{}] {}: {}".format(current_time, module, level, msg)
+    global _off
 
-    print(formatted_message)
+    severity = LEVELS[level]
+    if severity < LEVEL:
+        return
 
-def dev(module: str, msg: str) -> None:
+    if args:
+        msg = msg % args
+
+    # Milliseconds since boot. Reading the tick counter is much cheaper
+    # than querying the RTC for every entry
+    current_time = time.ticks_ms()
+    entry = "%d [%s] %s: %s\n" % (current_time, module, level.upper(), msg)
+
+    # A str exposes its UTF-8 data as a buffer so it can be copied into
+    # the log buffer without first encoding it to a new bytes object
+    data = memoryview(entry)
+    n = len(data)
+    if _off + n > BUF_SIZE:
+        flush()
+
+    if n > BUF_SIZE:
+        sys.stdout.write(entry)
+    else:
+        _mv[_off:_off + n] = data
+        _off += n
+
+    # Warnings and above are written straight away
+    if severity >= WARN or _off >= FLUSH_THRESHOLD or time.ticks_diff(current_time, _last_flush) >= FLUSH_INTERVAL:
+        flush()
+
+def flush() -> None:
+    """
+    flush Write out buffered log entries
+    """
+
+    global _off, _last_flush
+
+    if _off:
+        sys.stdout.write(_mv[:_off])
+        _off = 0
+    _last_flush = time.ticks_ms()
+
+def dev(module: str, msg: str, *args) -> None:
     """
     dev Write development log
     This should only be used for development as it is hidden
     normally in order to prevent overly verbose logs
     :param module: Section of application log originates from
     :type module: str
-    :param msg: Log message
+    :param msg: Log message. Formatted with args using % if args are
+        given
     :type msg: str
+    :param args: Arguments to format msg with
+    :type args: tuple
     """
 
-    log(module, msg, "dev")
+    if LEVEL > DEV:
+        return
+    log(module, msg, "dev", args)
 
-def debug(module: str, msg: str) -> None:
+def debug(module: str, msg: str, *args) -> None:
     """
     debug Write debug log
     :param module: Section of application log originates from
     :type module: str
-    :param msg: Log message
+    :param msg: Log message. Formatted with args using % if args are
+        given
     :type msg: str
+    :param args: Arguments to format msg with
+    :type args: tuple
     """
 
-    log(module, msg, "debug")
+    if LEVEL > DEBUG:
+        return
+    log(module, msg, "debug", args)
 
-def info(module: str, msg: str) -> None:
+def info(module: str, msg: str, *args) -> None:
     """
     info Write info log
     :param module: Section of application log originates from
     :type module: str
-    :param msg: Log message
+    :param msg: Log message. Formatted with args using % if args are
+        given
     :type msg: str
+    :param args: Arguments to format msg with
+    :type args: tuple
     """
 
-    log(module, msg, "info")
+    log(module, msg, "info", args)
 
-def warn(module: str, msg: str) -> None:
+def warn(module: str, msg: str, *args) -> None:
     """
     warn Write warn log
     :param module: Section of application log originates from
     :type module: str
-    :param msg: Log message
+    :param msg: Log message. Formatted with args using % if args are
+        given
     :type msg: str
+    :param args: Arguments to format msg with
+    :type args: tuple
     """
 
-    log(module, msg, "warn")
+    log(module, msg, "warn", args)
 
-def error(module: str, msg: str) -> None:
+def error(module: str, msg: str, *args) -> None:
     """
     error Write error log
     :param module: Section of application log originates from
     :type module: str
-    :param msg: Log message
+    :param msg: Log message. Formatted with args using % if args are
+        given
     :type msg: str
+    :param args: Arguments to format msg with
+    :type args: tuple
     """
 
-    log(module, msg, "error")
+    log(module, msg, "error", args)
 
-def fatal(module: str, msg: str) -> None:
+def fatal(module: str, msg: str, *args) -> None:
     """
     fatal Write fatal log
 
@@ -96,9 +192,12 @@ def fatal(module: str, msg: str) -> None:
 
     :param module: Section of application log originates from
     :type module: str
-    :param msg: Log message
+    :param msg: Log message. Formatted with args using % if args are
+        given
     :type msg: str
+    :param args: Arguments to format msg with
+    :type args: tuple
     """
 
-    log(module, msg, "fatal")
+    log(module, msg, "fatal", args)
     sys.exit(1)
@@ -5,18 +5,26 @@
 Main entrypoint for 
 """
 
-import sys
+import gc
 
 from .utils import alarm, initWLAN, readSettings
 from .HTTP import HTTP
-from .logging import debug, info, warn, error, fatal
+from .logging import debug, info, warn, error, fatal, flush
 
 
 def main() -> None:    
     settings = readSettings()
+    # Free everything left over from parsing the settings before the
+    # long lived server buffers are allocated
+    gc.collect()
+
     if not initWLAN(settings["SSID"], settings["KEY"], settings["TIMEOUT"], settings["STATIC"], settings["ADDR"], settings["MASK"], settings["GATEWAY"]):
-        print("ERROR Could not connect to Wi-Fi network")
-        sys.exit(1)
-    
-    server = HTTP(settings["PORT"], settings["MAX_CON"], settings["ADDR_FAMILY"])
-    server.listen()
\ No newline at end of file
+        fatal("Network", "Could not connect to Wi-Fi network")
+
+    server = HTTP(settings["PORT"], settings["MAX_CON"], settings["ADDR_FAMILY"], settings["VALIDATE_JSON"])
+
+    # Make sure buffered entries leading up to a crash aren't lost
+    try:
+        server.listen()
+    finally:
+        flush()
\ No newline at end of file
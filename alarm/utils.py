@@ -5,14 +5,29 @@
 Utility methods for use with the alarm
 """
 
+import micropython
 import network
 import time
-import sys
-import os
-import re
 from machine import Pin
 
-from .logging import debug, info, warn, error, fatal
+from .logging import debug, info, warn, error, fatal, flush
+
+# Expected settings. Each entry is a tuple of
+# (type, required, required_if, default, choices)
+SETTINGS_MODEL = {
+    "SSID": (str, True, None, None, None),
+    "KEY": (str, True, None, None, None),
+    "MAX_CON": (int, False, None, 5, None),
+    "TIMEOUT": (int, False, None, 10, None),
+    "PORT": (int, False, None, 80, None),
+    "STATIC": (bool, False, None, False, ("TRUE", "FALSE")),
+    # Can't validate IP here as MicroPython doesn't yet support full regex
+    "ADDR": (str, False, "STATIC", None, None),
+    "MASK": (str, False, "STATIC", None, None),
+    "GATEWAY": (str, False, "STATIC", None, None),
+    "ADDR_FAMILY": (str, False, "STATIC", None, ("INET", "INET6")),
+    "VALIDATE_JSON": (bool, False, None, False, ("TRUE", "FALSE"))
+}
 
 def initWLAN(SSID: str, key: str, timeout: int = 10, static: bool = False, ip: str = None, mask: str = None, gateway: str = None) -> bool:
     """
@@ -42,21 +57,24 @@ def initWLAN(SSID: str, key: str, timeout: int = 10, static: bool = False, ip: s
 
     sta_if = network.WLAN(network.STA_IF)
     sta_if.active(True)
-    if static:
-        # We don't use DNS so just set it to ourselves
-        info("Network", "Settings static IP")
-        sta_if.ifconfig((ip, mask, gateway, "127.0.0.1"))
     sta_if.connect(SSID, key)
 
-    timeout = 10
     start = time.time()
     while not sta_if.isconnected():
-            if (time.time() - start) > timeout:
-                break
+        if (time.time() - start) > timeout:
+            break
+        # Let the CPU idle between polls
+        time.sleep_ms(100)
+
+    # Set the static IP once connected so DHCP can't overwrite it
+    if static and sta_if.isconnected():
+        # We don't use DNS so just set it to ourselves
+        info("Network", "Settings static IP")
+        sta_if.ifconfig((ip, mask, gateway, "127.0.0.1"))
 
     ap_if = network.WLAN(network.AP_IF)
     ap_if.active(False)
-    info("Network", "Config {}".format(sta_if.ifconfig()))
+    info("Network", "Config %s", sta_if.ifconfig())
     return sta_if.isconnected()
 
 def readSettings() -> dict:
@@ -70,142 +88,61 @@ def readSettings() -> dict:
     :rtype: dict
     """
 
-    settings_model = {
-        "SSID": {
-            "type": str,
-            "required": True,
-            "required_if": None,
-            "default": None,
-            "regex": None
-        },
-        "KEY": {
-            "type": str,
-            "required": True,
-            "required_if": None,
-            "default": None,
-            "regex": None
-        },
-        "MAX_CON": {
-            "type": int,
-            "required": False,
-            "required_if": None,
-            "default": 5,
-            "regex": None
-        },
-        "TIMEOUT": {
-            "type": int,
-            "required": False,
-            "required_if": None,
-            "default": 10,
-            "regex": None
-        },
-        "PORT": {
-            "type": int,
-            "required": False,
-            "required_if": None,
-            "default": 80,
-            "regex": None
-        },
-        "STATIC": {
-            "type": bool,
-            "required": False,
-            "required_if": None,
-            "default": False,
-            "regex": "^(TRUE|FALSE)$"
-        },
-        "ADDR": {
-            "type": str,
-            "required": False,
-            "required_if": "STATIC",
-            "default": None,
-            "regex": None # Can't validate IP here as MicroPython doesn't yet support full regex
-        },
-        "MASK": {
-            "type": str,
-            "required": False,
-            "required_if": "STATIC",
-            "default": None,
-            "regex": None
-        },
-        "GATEWAY": {
-            "type": str,
-            "required": False,
-            "required_if": "STATIC",
-            "default": None,
-            "regex": None 
-        },
-        "ADDR_FAMILY": {
-            "type": str,
-            "required": False,
-            "required_if": "STATIC",
-            "default": None,
-            "regex": "^(INET|INET6)$"
-        }
-    }
-
-    if "settings.txt" not in os.listdir():
-        print("ERROR No settings.txt file found")
-        sys.exit(1)
-    
+    try:
+        f = open("settings.txt", "r")
+    except OSError:
+        fatal("Settings", "No settings.txt file found")
+
     settings = {}
-    
-    with open("settings.txt", "r") as f:
-        for i in f.readlines():
-            line = i.replace("\n", "").replace("\r", "").split("=")
+
+    with f:
+        for raw in f:
+            raw = raw.rstrip("\r\n")
+
+            # Skip blank lines and comments
+            if not raw or raw[0] == "#":
+                continue
+
+            line = raw.split("=", 1)
 
             # Make sure we only use valid setting keys
-            if line[0] in settings_model:
+            if len(line) == 2 and line[0] in SETTINGS_MODEL:
                 settings[line[0]] = line[1]
-            else:
-                continue
-    
+
     # Validate settings
-    for i in settings_model:
-        debug("Settings", "Validating {}".format(i))
+    for i in SETTINGS_MODEL:
+        setting_type, required, required_if, default, choices = SETTINGS_MODEL[i]
+
+        debug("Settings", "Validating %s", i)
         if i in settings:
-            debug("Settings", "Found {} in settings file".format(i))
-            if settings_model[i]["regex"] is not None and settings_model[i]["type"] == str:
-                pattern = re.compile(settings_model[i]["regex"])
-                if not pattern.match(settings[i]):
-                    fatal("Settings", "Value of {} does not match regex".format(i))
-
-            debug("Settings", "Expected type is {}".format(settings_model[i]["type"]))
-            if settings_model[i]["type"] == bool:
+            debug("Settings", "Found %s in settings file", i)
+            if choices is not None:
+                settings[i] = settings[i].upper()
+                if settings[i] not in choices:
+                    fatal("Settings", "Value of %s must be one of %s", i, choices)
+
+            debug("Settings", "Expected type is %s", setting_type)
+            if setting_type == bool:
                 settings[i] = settings[i].upper() == "TRUE"
             else:
                 try:
-                    settings[i] = settings_model[i]["type"](settings[i])
+                    settings[i] = setting_type(settings[i])
                 except ValueError:
-                    fatal("Settings", "{} is of wrong type. Found {}. Expected {}.".format(i, type(settings[i]), settings_model[i]["type"]))
+                    fatal("Settings", "%s is of wrong type. Found %s. Expected %s.", i, type(settings[i]), setting_type)
         else:
-            if settings_model[i]["required"]:
-                fatal("Settings", "Required setting {} not present in settings file".format(i))
-            if settings_model[i]["required_if"]:
-                if settings[settings_model[i]["required_if"]]:
-                    fatal("Settings", "Setting {} required as setting {} is set to True".format(i, settings_model[i]["required_if"]))
-            
-            info("Settings", "{} not found in settings. Using default of {}".format(i, settings_model[i]["default"]))
-            settings[i] = settings_model[i]["default"]
-        
-    return settings
+            if required:
+                fatal("Settings", "Required setting %s not present in settings file", i)
+            if required_if:
+                if settings[required_if]:
+                    fatal("Settings", "Setting %s required as setting %s is set to True", i, required_if)
 
-def getSubstringFromList(strings: list, substring: str) -> int:
-    """
-    getSubstringFromList Get index of first instance of string
-
-    :param strings: List to search
-    :type strings: list
-    :param substring: Substring to search for
-    :type substring: str
-    :return: Index. -1 if not found
-    :rtype: int
-    """
+            info("Settings", "%s not found in settings. Using default of %s", i, default)
+            settings[i] = default
 
-    for i, s in enumerate(strings):
-        if substring in s:
-              return i
-    return -1
+    flush()
+    return settings
 
+@micropython.native
 def alarm(buzzer: Pin, enabled_for: int, on: int, off: int) -> None:
     """
     alarm Activate the buzzer
@@ -223,11 +160,17 @@ def alarm(buzzer: Pin, enabled_for: int, on: int, off: int) -> None:
     :type off: int
     """
 
-    start = time.ticks_ms()
+    # Look everything up once rather than on every iteration
+    ticks_diff = time.ticks_diff
+    ticks_ms = time.ticks_ms
+    sleep_ms = time.sleep_ms
+    buzzer_on = buzzer.on
+    buzzer_off = buzzer.off
 
+    start = ticks_ms()
 
-    while time.ticks_diff(time.ticks_ms(), start) < enabled_for:
-        buzzer.on()
-        time.sleep_ms(on)
-        buzzer.off()
-        time.sleep_ms(off)
+    while ticks_diff(ticks_ms(), start) < enabled_for:
+        buzzer_on()
+        sleep_ms(on)
+        buzzer_off()
+        sleep_ms(off)